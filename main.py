@@ -1,13 +1,19 @@
-import os, hmac, hashlib, base64, time, json, requests
-from typing import Optional, Dict, Any, List
-from datetime import datetime
+import os, re, sys, socket, gzip, hmac, hashlib, base64, time, random, asyncio, heapq, itertools, sqlite3, queue, logging
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional, Dict, Any, List, Tuple
+from collections import OrderedDict
+from datetime import datetime, timezone
+from functools import lru_cache
 from threading import Lock
 
-from fastapi import FastAPI, Request, HTTPException, BackgroundTasks, Query, Depends, Header
+from fastapi import FastAPI, Request, HTTPException, Query, Depends, Header
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import Response, HTMLResponse
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import Response, HTMLResponse, ORJSONResponse, StreamingResponse
 from pydantic import BaseModel
-import resend
+import httpx
+import orjson
+from jinja2 import Environment, select_autoescape
 
 # =========================
 # ENV & GLOBALS
@@ -29,78 +35,452 @@ SHOP_DOMAIN = os.getenv("SHOP_DOMAIN", "")  # es. eccomionline.myshopify.com
 SHOP_ADMIN_TOKEN = os.getenv("SHOP_ADMIN_TOKEN", "")
 SHOPIFY_API_VER = os.getenv("SHOPIFY_API_VER", "2025-10")
 
-DATA_FILE = os.getenv("DATA_FILE", "/mnt/data/jobs.json")
+DATA_FILE = os.getenv("DATA_FILE", "/mnt/data/jobs.json")  # legacy: importato nel DB al primo avvio
+DB_FILE = os.getenv("DB_FILE", os.path.splitext(DATA_FILE)[0] + ".db")
 
-if RESEND_KEY:
-    resend.api_key = RESEND_KEY
+DEBUG = os.getenv("DEBUG", "").lower() in ("1", "true", "yes")
+
+# URL pubblico del servizio (es. https://eccomi-video.onrender.com): se impostato i provider
+# avvisano via webhook e il polling resta solo come rete di sicurezza
+PUBLIC_BASE_URL = os.getenv("PUBLIC_BASE_URL", "").rstrip("/")
 
 # =========================
-# STORAGE (persistenza leggera)
+# LOGGING (QueueHandler: chi logga non scrive mai direttamente su stdout)
 # =========================
-JOBS: Dict[str, Dict[str, Any]] = {}
-JOBS_LOCK = Lock()
+log = logging.getLogger("eccomi")
+log.setLevel(logging.DEBUG if DEBUG else logging.INFO)
+log.propagate = False
+_LOG_QUEUE: "queue.Queue[logging.LogRecord]" = queue.Queue(-1)
+log.addHandler(QueueHandler(_LOG_QUEUE))
+_log_stream = logging.StreamHandler(sys.stdout)
+_log_stream.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+_LOG_LISTENER = QueueListener(_LOG_QUEUE, _log_stream)
+_LOG_LISTENER.start()
 
-def _now_iso():
-    return datetime.utcnow().isoformat() + "Z"
+# =========================
+# STORAGE (SQLite, una riga per job; gli shard in memoria fanno da cache)
+# =========================
+# JOBS diviso in shard con lock propri: poller e dashboard non si contendono un unico lock.
+# Ogni shard è ordinato per ultimo aggiornamento (il più recente in fondo).
+JOBS_SHARDS = 16
+_SHARDS: List[Tuple[Lock, "OrderedDict[str, Dict[str, Any]]"]] = [(Lock(), OrderedDict()) for _ in range(JOBS_SHARDS)]
+JOBS_MAX = int(os.getenv("JOBS_MAX", "5000"))  # job tenuti in memoria; i più vecchi restano solo su DB
+_SHARD_MAX = max(1, JOBS_MAX // JOBS_SHARDS)
+DB_LOCK = Lock()  # una sola connessione SQLite condivisa tra thread
+# attesa breve sul lock di scrittura di un altro worker (il default di sqlite3 è 5s), poi si riprova
+DB_BUSY_SEC = float(os.getenv("DB_BUSY_SEC", "0.2"))
+DB_WRITE_ATTEMPTS = 5
+
+def _shard(job_id: str):
+    return _SHARDS[hash(job_id) % JOBS_SHARDS]
+
+# timestamp interni in ns (time.time_ns); in ISO solo quando escono dalle API admin
+def _ns_iso(ns: Optional[int]) -> Optional[str]:
+    if ns is None:
+        return None
+    return datetime.fromtimestamp(ns / 1e9, tz=timezone.utc).isoformat().replace("+00:00", "Z")
+
+def _iso_ns(s: Optional[str]) -> int:
+    try:
+        return int(datetime.fromisoformat(s.rstrip("Z")).replace(tzinfo=timezone.utc).timestamp() * 1e9)
+    except Exception:
+        return 0
+
+def _job_view(j: Dict[str, Any]) -> Dict[str, Any]:
+    v = {k: x for k, x in j.items() if k not in ("created_at_ns", "updated_at_ns")}
+    if "created_at_ns" in j:
+        v["created_at"] = _ns_iso(j["created_at_ns"])
+    if "updated_at_ns" in j:
+        v["updated_at"] = _ns_iso(j["updated_at_ns"])
+    return v
+
+def _db_open():
+    try:
+        os.makedirs(os.path.dirname(DB_FILE) or ".", exist_ok=True)
+        conn = sqlite3.connect(DB_FILE, timeout=DB_BUSY_SEC, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " id TEXT PRIMARY KEY, payload TEXT NOT NULL, status TEXT,"
+            " created_at TEXT, updated_at TEXT, lease_owner TEXT, lease_until REAL)"
+        )
+        cols = {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}
+        for col, decl in (("lease_owner", "TEXT"), ("lease_until", "REAL"), ("wake_at", "REAL")):
+            if col not in cols:
+                conn.execute(f"ALTER TABLE jobs ADD COLUMN {col} {decl}")
+        # la dashboard legge dal DB per updated_at; le sveglie cercano pochi job per lease_owner
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_updated ON jobs (CAST(updated_at AS INTEGER))")
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_wake ON jobs (lease_owner) WHERE wake_at IS NOT NULL")
+        return conn
+    except Exception as e:
+        log.warning("⚠️ storage open error: %s", e)
+        return None
 
-def _storage_load():
+DB = _db_open()
+
+def _storage_load_legacy():
+    # vecchio formato: un unico jobs.json riscritto a ogni update
     try:
         if os.path.exists(DATA_FILE):
-            with open(DATA_FILE, "r", encoding="utf-8") as f:
-                d = json.load(f)
+            with open(DATA_FILE, "rb") as f:
+                d = orjson.loads(f.read())
             return d if isinstance(d, dict) else {}
     except Exception as e:
-        print("⚠️ storage load error:", e)
+        log.warning("⚠️ storage load error: %s", e)
     return {}
 
-def _storage_save():
+# import del vecchio jobs.json: i job non ancora finiti erano seguiti da un thread del processo
+# fermato col deploy. Si riprendono quelli ancora dentro la finestra di polling del vecchio codice
+# (D-ID 600s, HeyGen 1200s e solo con email, come allora); stati finali di entrambi i provider
+_LEGACY_FINAL = frozenset({"done", "error", "failed", "completed", "succeeded", "canceled"})
+_LEGACY_POLL_SEC = {"d-id": 600, "heygen": 1200}
+
+def _legacy_in_flight(job: Dict[str, Any], now_ns: int) -> bool:
+    window = _LEGACY_POLL_SEC.get(job.get("provider"))
+    if window is None or job.get("video_url") or (job.get("status") or "") in _LEGACY_FINAL:
+        return False
+    if job["provider"] == "heygen" and not job.get("to_email"):
+        return False
+    return job.get("created_at_ns", 0) + window * 10**9 > now_ns
+
+def _storage_load():
+    if DB is None:
+        return _storage_load_legacy()
+    try:
+        with DB_LOCK:
+            rows = DB.execute("SELECT id, payload FROM jobs").fetchall()
+    except Exception as e:
+        log.warning("⚠️ storage load error: %s", e)
+        return {}
+    imported = not rows
+    jobs = {jid: orjson.loads(payload) for jid, payload in rows} if rows else _storage_load_legacy()
+    now_ns = time.time_ns()
+    for jid, job in jobs.items():
+        stale = "updated_at_ns" not in job  # salvato prima dei timestamp in ns: conversione una tantum
+        if stale:
+            job["created_at_ns"] = _iso_ns(job.pop("created_at", None))
+            job["updated_at_ns"] = _iso_ns(job.pop("updated_at", None))
+        if imported and _legacy_in_flight(job, now_ns):
+            job["polling"] = True  # poll_resume lo riprende all'avvio
+        if stale or imported:
+            _storage_save(jid, job)
+    return jobs
+
+def _storage_save(job_id: str, job: Dict[str, Any]):
+    if DB is None:
+        return
+    try:
+        with DB_LOCK:
+            DB.execute(
+                "INSERT INTO jobs (id, payload, status, created_at, updated_at) VALUES (?, ?, ?, ?, ?)"
+                " ON CONFLICT(id) DO UPDATE SET payload=excluded.payload, status=excluded.status,"
+                " updated_at=excluded.updated_at"
+                # migrazione al boot: non sovrascrive una riga già aggiornata da un altro worker
+                " WHERE CAST(excluded.updated_at AS INTEGER) >= CAST(jobs.updated_at AS INTEGER)",
+                # decodificato: come BLOB json_extract non lo leggerebbe più come testo JSON
+                (job_id, orjson.dumps(job).decode("utf-8"), job.get("status"),
+                 job.get("created_at_ns"), job.get("updated_at_ns")),
+            )
+    except Exception as e:
+        log.warning("⚠️ storage save error: %s", e)
+
+def _storage_merge(job_id: str, data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    # fonde data sulla riga attuale del DB in una sola transazione: con più worker la copia in
+    # cache di questo processo può essere vecchia e riscriverla cancellerebbe i campi degli altri.
+    # Se il DB resta occupato si solleva: il chiamante non deve credere salvato un job che non lo è
+    if DB is None:
+        return None
+    for attempt in range(DB_WRITE_ATTEMPTS):
+        try:
+            with DB_LOCK:
+                DB.execute("BEGIN IMMEDIATE")
+                try:
+                    row = DB.execute("SELECT payload FROM jobs WHERE id=?", (job_id,)).fetchone()
+                    job = orjson.loads(row[0]) if row else {}
+                    job.update(data)
+                    # monotono rispetto alla riga letta, anche se l'orologio di un altro worker è avanti
+                    now = max(time.time_ns(), job.get("updated_at_ns", 0) + 1)
+                    job.setdefault("created_at_ns", now)
+                    job["updated_at_ns"] = now
+                    DB.execute(
+                        "INSERT INTO jobs (id, payload, status, created_at, updated_at) VALUES (?, ?, ?, ?, ?)"
+                        " ON CONFLICT(id) DO UPDATE SET payload=excluded.payload, status=excluded.status,"
+                        " updated_at=excluded.updated_at",
+                        (job_id, orjson.dumps(job).decode("utf-8"), job.get("status"),
+                         job.get("created_at_ns"), job.get("updated_at_ns")),
+                    )
+                    DB.execute("COMMIT")
+                except BaseException:
+                    DB.execute("ROLLBACK")
+                    raise
+            return job
+        except sqlite3.OperationalError as e:
+            # "database is locked": un altro worker sta scrivendo; si attende fuori da DB_LOCK
+            if attempt == DB_WRITE_ATTEMPTS - 1:
+                log.error("❌ storage save error: %s %s %r", job_id, e, data)
+                raise
+            time.sleep(DB_BUSY_SEC * 2 ** attempt)
+        except Exception as e:
+            log.error("❌ storage save error: %s %s %r", job_id, e, data)
+            raise
+
+def _storage_get(job_id: str) -> Optional[Dict[str, Any]]:
+    if DB is None:
+        return None
+    try:
+        with DB_LOCK:
+            row = DB.execute("SELECT payload FROM jobs WHERE id=?", (job_id,)).fetchone()
+    except Exception as e:
+        log.warning("⚠️ storage load error: %s", e)
+        return None
+    return orjson.loads(row[0]) if row else None
+
+def _storage_recent(limit: int, since: int = 0) -> Optional[List[Dict[str, Any]]]:
+    # con più worker ognuno ha in cache solo i job che ha toccato lui: liste e refresh si leggono dal DB
+    if DB is None:
+        return None
+    try:
+        with DB_LOCK:
+            rows = DB.execute(
+                "SELECT payload FROM jobs WHERE CAST(updated_at AS INTEGER) > ?"
+                " ORDER BY CAST(updated_at AS INTEGER) DESC LIMIT ?", (since, limit)
+            ).fetchall()
+    except Exception as e:
+        log.warning("⚠️ storage load error: %s", e)
+        return None
+    return [orjson.loads(payload) for (payload,) in rows]
+
+def _storage_version() -> Optional[int]:
+    # ultimo updated_at scritto da qualunque worker (le righe non si cancellano mai)
+    if DB is None:
+        return None
+    try:
+        with DB_LOCK:
+            row = DB.execute("SELECT MAX(CAST(updated_at AS INTEGER)) FROM jobs").fetchone()
+    except Exception as e:
+        log.warning("⚠️ storage load error: %s", e)
+        return None
+    return row[0] or 0
+
+def _storage_polling() -> List[Dict[str, Any]]:
+    if DB is None:
+        return [j for j in _jobs_list() if j.get("polling")]
     try:
-        os.makedirs(os.path.dirname(DATA_FILE), exist_ok=True)
-        with open(DATA_FILE, "w", encoding="utf-8") as f:
-            json.dump(JOBS, f, ensure_ascii=False, indent=2)
+        with DB_LOCK:
+            rows = DB.execute("SELECT payload FROM jobs WHERE json_extract(payload, '$.polling')").fetchall()
     except Exception as e:
-        print("⚠️ storage save error:", e)
+        log.warning("⚠️ storage load error: %s", e)
+        return []
+    return [orjson.loads(payload) for (payload,) in rows]
+
+# versione della cache: cambia a ogni scrittura (dopo la modifica), invalida lo snapshot admin
+_JOBS_VER = itertools.count(1)
+JOBS_VERSION = 0
+
+def _jobs_put(job_id: str, job: Dict[str, Any]):
+    # da chiamare col lock dello shard
+    global JOBS_VERSION
+    lk, d = _shard(job_id)
+    d[job_id] = job
+    d.move_to_end(job_id)
+    while len(d) > _SHARD_MAX:
+        d.popitem(last=False)
+    JOBS_VERSION = next(_JOBS_VER)
 
 def _jobs_upsert(job_id: str, data: dict):
     if not job_id:
         return
-    with JOBS_LOCK:
-        base = JOBS.get(job_id, {})
-        base.update(data)
-        base.setdefault("created_at", _now_iso())
-        base["updated_at"] = _now_iso()
-        JOBS[job_id] = base
-        _storage_save()
+    merged = _storage_merge(job_id, data)  # I/O su disco senza tenere il lock dello shard; solleva se fallisce
+    lk, d = _shard(job_id)
+    with lk:
+        cur = d.get(job_id)
+        if merged is None:
+            # senza DB la cache è l'unica copia: si fonde lì
+            merged = dict(cur or {})
+            merged.update(data)
+            now = time.time_ns()
+            merged.setdefault("created_at_ns", now)
+            merged["updated_at_ns"] = now
+        elif cur is not None and cur.get("updated_at_ns", 0) > merged["updated_at_ns"]:
+            return  # in cache c'è già una versione più recente
+        _jobs_put(job_id, merged)
+
+async def _jobs_save(job_id: str, data: dict):
+    # dal loop: la transazione SQLite (con eventuali attese e retry) gira in un thread
+    if DB is None:
+        return _jobs_upsert(job_id, data)
+    await asyncio.to_thread(_jobs_upsert, job_id, data)
+
+def _jobs_get(job_id: str) -> Optional[Dict[str, Any]]:
+    # il singolo job si legge dal DB (un altro worker può averlo aggiornato) e si rinfresca la cache
+    j = _storage_get(job_id)
+    lk, d = _shard(job_id)
+    with lk:
+        cur = d.get(job_id)
+        if j is None or (cur is not None and cur.get("updated_at_ns", 0) >= j.get("updated_at_ns", 0)):
+            return cur if cur is not None else j
+        if cur is not None:
+            _jobs_put(job_id, j)
+    return j
+
+def _jobs_list(limit: Optional[int] = None):
+    jobs = _storage_recent(limit or JOBS_MAX)
+    if jobs is not None:
+        return jobs
+    # senza DB: ogni shard è già ordinato: basta un merge, dal più recente; con limit bastano i primi K di ogni shard
+    parts = []
+    for lk, d in _SHARDS:
+        with lk:
+            parts.append(list(itertools.islice(reversed(d.values()), limit)))
+    merged = heapq.merge(*parts, key=lambda j: j.get("updated_at_ns", 0), reverse=True)
+    return list(itertools.islice(merged, limit))
+
+def _jobs_since(cursor: int):
+    # solo i job con updated_at_ns > cursor: da ogni shard si leggono le code, non tutta la lista
+    jobs = _storage_recent(JOBS_MAX, cursor)
+    if jobs is not None:
+        return jobs
+    newer = lambda j: j.get("updated_at_ns", 0) > cursor
+    parts = []
+    for lk, d in _SHARDS:
+        with lk:
+            parts.append(list(itertools.takewhile(newer, reversed(d.values()))))
+    return list(heapq.merge(*parts, key=lambda j: j.get("updated_at_ns", 0), reverse=True))
+
+def _jobs_version() -> int:
+    # cambia a ogni scrittura: con il DB anche a quelle degli altri worker, che JOBS_VERSION non vede
+    v = _storage_version()
+    return JOBS_VERSION if v is None else v
+
+# carica a boot (ordinati per updated_at_ns, solo gli ultimi JOBS_MAX in memoria)
+for _jid, _job in sorted(_storage_load().items(), key=lambda kv: kv[1].get("updated_at_ns", 0)):
+    _jobs_put(_jid, _job)
+
+# =========================
+# HTTP CLIENT (un pool keep-alive + HTTP/2 per provider, header fissi sul client)
+# =========================
+HTTP_CLIENTS: List[httpx.AsyncClient] = []
+
+HTTP_RETRIES = 3  # solo errori di connessione: la richiesta non è partita, sicuro anche per i POST
+# keepalive TCP: le connessioni del poller restano ferme fino a un minuto tra un controllo e l'altro
+HTTP_SOCKET_OPTS = [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+if hasattr(socket, "TCP_KEEPIDLE"):
+    HTTP_SOCKET_OPTS += [(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 30),
+                         (socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 10),
+                         (socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)]
+
+def _http_client(base_url: str, headers: Dict[str, str]) -> httpx.AsyncClient:
+    c = httpx.AsyncClient(
+        base_url=base_url,
+        headers=headers,
+        timeout=httpx.Timeout(20),
+        transport=httpx.AsyncHTTPTransport(
+            http2=True,
+            retries=HTTP_RETRIES,
+            socket_options=HTTP_SOCKET_OPTS,
+            limits=httpx.Limits(max_keepalive_connections=32, max_connections=128, keepalive_expiry=60),
+        ),
+    )
+    HTTP_CLIENTS.append(c)
+    return c
+
+ERR_BODY_MAX = 300
 
-def _jobs_list():
-    with JOBS_LOCK:
-        return sorted(JOBS.values(), key=lambda x: x.get("updated_at",""), reverse=True)
+def _body_snippet(r) -> str:
+    # taglia i byte prima di decodificare: niente decode completo di risposte d'errore enormi
+    return r.content[:ERR_BODY_MAX].decode("utf-8", "replace")
 
-# carica a boot
-JOBS.update(_storage_load())
+def _retry_after(r, attempt: int) -> float:
+    # Retry-After del server se c'è, altrimenti backoff esponenziale (anche per errori di rete, r=None)
+    try:
+        return float(r.headers.get("Retry-After", "")) if r is not None else 0.5 * 2 ** attempt
+    except ValueError:
+        return 0.5 * 2 ** attempt
+
+# cache breve degli stati provider per gli endpoint pubblici: chi chiede lo stesso id a pochi secondi
+# di distanza riusa la stessa risposta. Il poller non legge da qui (vuole sempre lo stato vero),
+# ma ci scrive ogni risposta che ottiene (solo event loop, niente lock)
+STATUS_TTL = float(os.getenv("STATUS_TTL", "4"))
+STATUS_CACHE_MAX = 2048
+_STATUS_CACHE: "OrderedDict[Tuple[str, str], Tuple[float, Dict[str, Any]]]" = OrderedDict()
+STATUS_CACHE_STATS = {"hit": 0, "miss": 0}
+
+async def _status_cached(provider: str, vid: str, fetch) -> Dict[str, Any]:
+    key = (provider, vid)
+    hit = _STATUS_CACHE.get(key)
+    if hit and hit[0] > time.monotonic():
+        STATUS_CACHE_STATS["hit"] += 1
+        return hit[1]
+    STATUS_CACHE_STATS["miss"] += 1
+    s = await fetch(vid)
+    _status_store(provider, vid, s)
+    return s
+
+def _status_store(provider: str, vid: str, s: Dict[str, Any]):
+    key = (provider, vid)
+    _STATUS_CACHE[key] = (time.monotonic() + STATUS_TTL, s)
+    _STATUS_CACHE.move_to_end(key)
+    while len(_STATUS_CACHE) > STATUS_CACHE_MAX:
+        _STATUS_CACHE.popitem(last=False)
 
 # =========================
 # APP
 # =========================
-app = FastAPI(title="Eccomi Video Automation", version="2.3")
+app = FastAPI(title="Eccomi Video Automation", version="2.3", default_response_class=ORJSONResponse)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["https://www.eccomionline.com", "https://eccomionline.com", "*"],
     allow_methods=["*"],
     allow_headers=["*", "Authorization"],
 )
+class _GZipNoStream(GZipMiddleware):
+    # niente gzip sugli stream SSE: GzipFile non fa flush e gli eventi resterebbero nel buffer
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"].endswith("/stream"):
+            await self.app(scope, receive, send)
+            return
+        await super().__call__(scope, receive, send)
+
+# gzip per le risposte JSON (lista job admin); la dashboard è già compressa e il middleware la lascia passare
+app.add_middleware(_GZipNoStream, minimum_size=512, compresslevel=6)
+
+@app.on_event("startup")
+async def _start_workers():
+    poll_resume()
+    app.state.poller = asyncio.create_task(poll_worker())
+    app.state.mailer = asyncio.create_task(email_worker())
+
+@app.on_event("shutdown")
+async def _shutdown():
+    app.state.poller.cancel()
+    app.state.mailer.cancel()
+    await asyncio.gather(app.state.poller, app.state.mailer, return_exceptions=True)
+    await email_flush()  # le email in coda partono prima di chiudere i client
+    for c in HTTP_CLIENTS:
+        await c.aclose()
+    _LOG_LISTENER.stop()
 
 # =========================
 # AUTH (Bearer)
 # =========================
+_ADMIN_TOKEN_B = ADMIN_TOKEN.encode("utf-8")
+
+@lru_cache(maxsize=128)  # la dashboard manda sempre lo stesso header: parse e confronto una volta sola
+def _admin_auth_error(authorization: str) -> Optional[str]:
+    if not authorization.lower().startswith("bearer "):
+        return "Missing Bearer token"
+    token = authorization.split(" ", 1)[1].strip()
+    if not hmac.compare_digest(token.encode("utf-8"), _ADMIN_TOKEN_B):
+        return "Unauthorized"
+    return None
+
 def require_admin_header(authorization: str = Header(None)):
     if not ADMIN_TOKEN:
         raise HTTPException(500, "ADMIN_TOKEN non configurato")
-    if not authorization or not authorization.lower().startswith("bearer "):
-        raise HTTPException(401, "Missing Bearer token")
-    token = authorization.split(" ", 1)[1].strip()
-    if token != ADMIN_TOKEN:
-        raise HTTPException(401, "Unauthorized")
+    err = _admin_auth_error(authorization) if authorization else "Missing Bearer token"
+    if err:
+        raise HTTPException(401, err)
     return True
 
 # =========================
@@ -152,171 +532,514 @@ class ManualAvatarAudioReq(BaseModel):
 # =========================
 # EMAIL
 # =========================
+# Le email vanno in coda e partono a blocchi con una sola POST a /emails/batch di Resend.
+# Chiamata diretta (invece dell'SDK resend) per avere pool keep-alive e timeout espliciti.
+RESEND_CLIENT = _http_client("https://api.resend.com",
+                             {"Authorization": f"Bearer {RESEND_KEY}", "Content-Type": "application/json"})
+EMAIL_TIMEOUT = 10
+EMAIL_QUEUE: "asyncio.Queue[Dict[str, Any]]" = asyncio.Queue()
+EMAIL_BATCH_MAX = 100      # limite dell'endpoint batch di Resend
+EMAIL_BATCH_WINDOW = 1.0   # secondi di attesa per riempire un blocco
+EMAIL_ATTEMPTS = 6         # tentativi per blocco su 429/5xx/errori di rete (~30s di backoff in tutto)
+EMAIL_RETRY_MAX_WAIT = 30.0
+EMAIL_SEND_GAP = 0.6       # pausa tra invii singoli: Resend accetta ~2 richieste/s
+# blocco che il worker ha in mano (raccolto o in invio): allo shutdown si recupera da qui
+_EMAIL_INFLIGHT: Dict[str, Any] = {"key": None, "batch": []}
+
+# controllo di forma, non di esistenza: basta a non far rifiutare a Resend l'intero blocco
+_EMAIL_RE = re.compile(r"[^@\s,;<>]+@[^@\s,;<>]+\.[^@\s,;<>]+")
+
 def send_email(to_email: str, subject: str, html: str):
     if not RESEND_KEY:
-        print("⚠️ RESEND_API_KEY mancante: salto invio email")
+        log.warning("⚠️ RESEND_API_KEY mancante: salto invio email")
+        return
+    if not _EMAIL_RE.fullmatch((to_email or "").strip()):
+        log.warning("⚠️ Email destinatario non valida, salto invio: %r", to_email)
         return
+    EMAIL_QUEUE.put_nowait({"from": FROM_EMAIL, "to": to_email.strip(), "subject": subject, "html": html})
+
+async def _email_post(path: str, payload, key: str) -> Optional[httpx.Response]:
+    # stessa Idempotency-Key a ogni tentativo: un retry dopo un timeout non duplica l'email
     try:
-        r = resend.Emails.send({"from": FROM_EMAIL, "to": to_email, "subject": subject, "html": html})
-        print("✅ Email inviata:", r)
-    except Exception as e:
-        print("❌ ERRORE invio email:", e)
+        r = await RESEND_CLIENT.post(path, content=orjson.dumps(payload), timeout=EMAIL_TIMEOUT,
+                                     headers={"Idempotency-Key": key})
+    except httpx.HTTPError as e:
+        log.error("❌ ERRORE invio email: %r", e)
+        return None
+    if r.status_code != 200:
+        log.error("❌ ERRORE invio email: %s %s", r.status_code, _body_snippet(r))
+    return r
+
+async def _email_deliver(batch: List[Dict[str, Any]], key: str, attempts: int = EMAIL_ATTEMPTS,
+                         max_wait: float = EMAIL_RETRY_MAX_WAIT, path: str = "/emails/batch"):
+    payload = batch if path == "/emails/batch" else batch[0]
+    for attempt in range(attempts):
+        r = await _email_post(path, payload, key)
+        if r is not None and r.status_code == 200:
+            log.info("✅ Email inviate (%d): %s", len(batch), _body_snippet(r))
+            return
+        if r is not None and r.status_code != 429 and r.status_code < 500:
+            if path == "/emails/batch" and len(batch) > 1:
+                # il batch è tutto-o-niente: un messaggio rifiutato non deve far perdere gli altri
+                for i, msg in enumerate(batch):
+                    if i:
+                        await asyncio.sleep(EMAIL_SEND_GAP)
+                    await _email_deliver([msg], f"{key}-{i}", attempts, max_wait, path="/emails")
+            return
+        if attempt + 1 < attempts:
+            await asyncio.sleep(min(_retry_after(r, attempt), max_wait))
+    log.error("❌ Email non inviate dopo %d tentativi: %s", attempts, [m["to"] for m in batch])
+
+async def email_worker():
+    while True:
+        batch = [await EMAIL_QUEUE.get()]
+        _EMAIL_INFLIGHT.update(key=os.urandom(12).hex(), batch=batch)
+        deadline = time.monotonic() + EMAIL_BATCH_WINDOW
+        while len(batch) < EMAIL_BATCH_MAX:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(EMAIL_QUEUE.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        await _email_deliver(batch, _EMAIL_INFLIGHT["key"])
+        _EMAIL_INFLIGHT.update(key=None, batch=[])
+
+async def email_flush():
+    # allo shutdown (worker già fermo): il blocco che aveva in mano e la coda partono subito,
+    # con pochi tentativi brevi per stare nei tempi di arresto
+    pending = []
+    if _EMAIL_INFLIGHT["batch"]:
+        pending.append((_EMAIL_INFLIGHT["key"], _EMAIL_INFLIGHT["batch"]))
+    rest = []
+    while not EMAIL_QUEUE.empty():
+        rest.append(EMAIL_QUEUE.get_nowait())
+    for i in range(0, len(rest), EMAIL_BATCH_MAX):
+        pending.append((os.urandom(12).hex(), rest[i:i + EMAIL_BATCH_MAX]))
+    for key, batch in pending:
+        await _email_deliver(batch, key, attempts=2, max_wait=2.0)
+    _EMAIL_INFLIGHT.update(key=None, batch=[])
 
 # =========================
 # D-ID (Photo → Talking Video)
 # =========================
-def did_headers():
-    if not DID_KEY:
+_DID_AUTH = "Basic " + base64.b64encode((DID_KEY + ":").encode("utf-8")).decode("utf-8") if DID_KEY else None
+_DID_HEADERS = {"Authorization": _DID_AUTH, "Content-Type": "application/json"} if _DID_AUTH else {}
+DID_CLIENT = _http_client("https://api.d-id.com", _DID_HEADERS)
+
+def _did_client() -> httpx.AsyncClient:
+    if not _DID_AUTH:
         raise HTTPException(500, "D_ID_API_KEY mancante")
-    token = base64.b64encode((DID_KEY + ":").encode("utf-8")).decode("utf-8")
-    return {"Authorization": f"Basic {token}", "Content-Type": "application/json"}
+    return DID_CLIENT
+
+# voce "<prefisso>:<id>" → provider TTS di D-ID (prefisso sconosciuto = microsoft)
+DID_VOICE_PROVIDERS = {"ms": "microsoft", "eleven": "elevenlabs"}
+DID_DEFAULT_VOICE = "it-IT-GiuseppeNeural"
+
+@lru_cache(maxsize=64)
+def _did_voice_provider(voice: str) -> Dict[str, str]:
+    # poche voci distinte per deployment: il dict risolto viene riusato (mai modificato)
+    head, sep, tail = voice.partition(":")
+    if sep:
+        return {"type": DID_VOICE_PROVIDERS.get(head, "microsoft"), "voice_id": tail}
+    return {"type": "microsoft", "voice_id": DID_DEFAULT_VOICE}
+
+_DID_TALK_CONFIG = {"stitch": True}  # parte fissa del body di /talks (solo serializzata, mai modificata)
 
 def make_did_payload(job: Job) -> Dict[str, Any]:
-    payload = {"source_url": job.image_url, "config": {"stitch": True}}
+    payload = {"source_url": job.image_url, "config": _DID_TALK_CONFIG}
     if job.audio_url:
         payload["audio_url"] = job.audio_url
     else:
-        if (job.voice or "").startswith("eleven:"):
-            provider = {"type": "elevenlabs", "voice_id": job.voice.split(":", 1)[1]}
-        else:
-            voice_id = job.voice.split(":", 1)[1] if ":" in (job.voice or "") else "it-IT-GiuseppeNeural"
-            provider = {"type": "microsoft", "voice_id": voice_id}
+        provider = _did_voice_provider(job.voice or "")
         payload["script"] = {"type": "text", "input": job.script or "Ciao! Il tuo video è pronto.", "provider": provider}
+    if PUBLIC_BASE_URL:
+        payload["webhook"] = f"{PUBLIC_BASE_URL}/api/hooks/did"
     return payload
 
-def did_create_talk(job: Job) -> Dict[str, Any]:
-    r = requests.post("https://api.d-id.com/talks", headers=did_headers(), json=make_did_payload(job), timeout=90)
+async def did_create_talk(job: Job) -> Dict[str, Any]:
+    r = await _did_client().post("/talks", content=orjson.dumps(make_did_payload(job)), timeout=90)
     if r.status_code not in (200, 201):
-        raise HTTPException(r.status_code, f"D-ID create error: {r.text}")
+        raise HTTPException(r.status_code, f"D-ID create error: {_body_snippet(r)}")
     return r.json()
 
-def did_status(talk_id: str) -> Dict[str, Any]:
-    r = requests.get(f"https://api.d-id.com/talks/{talk_id}", headers=did_headers(), timeout=60)
+async def _did_status_fetch(talk_id: str) -> Dict[str, Any]:
+    r = await _did_client().get(f"/talks/{talk_id}", timeout=60)
     if r.status_code != 200:
-        raise HTTPException(r.status_code, f"D-ID status error: {r.text}")
+        raise HTTPException(r.status_code, f"D-ID status error: {_body_snippet(r)}")
     return r.json()
 
-def poll_and_notify_did(job: Job, talk_id: str, max_wait_sec: int = 600, every_sec: int = 5):
-    _jobs_upsert(talk_id, {"id": talk_id, "provider": "d-id", "status": "queued",
-                           "to_email": job.to_email, "order_name": job.order_name})
-    waited = 0
-    while waited <= max_wait_sec:
-        s = did_status(talk_id)
-        st = s.get("status")
-        video_url = s.get("result_url")
-        _jobs_upsert(talk_id, {"status": st or "", "video_url": video_url, "raw": s})
-        if st == "done" and video_url:
-            if job.to_email:
-                html = (
-                    '<p>Ciao! 👋</p><p>Il tuo <b>Video Parlante AI</b> è pronto.</p>'
-                    f'<p><a href="{video_url}" target="_blank">Scarica il video</a></p>'
-                )
-                send_email(job.to_email, f"Video AI pronto — Ordine {job.order_name or ''}", html)
-            return
-        if st in ("error", "failed"):
-            if job.to_email:
-                send_email(job.to_email, f"Problema con il tuo Video AI — Ordine {job.order_name or ''}",
-                           "<p>Si è verificato un errore. Ti contatteremo a breve.</p>")
-            return
-        time.sleep(every_sec)
-        waited += every_sec
-    if job.to_email:
-        send_email(job.to_email, f"Stiamo completando il tuo Video AI — Ordine {job.order_name or ''}",
-                   "<p>La generazione richiede più tempo del previsto. Ti avviseremo appena pronto.</p>")
+async def did_status(talk_id: str) -> Dict[str, Any]:
+    return await _status_cached("d-id", talk_id, _did_status_fetch)
+
+def _did_extract(s: Dict[str, Any]) -> Tuple[str, Optional[str], Any]:
+    return s.get("status") or "", s.get("result_url"), s.get("error")
 
 # =========================
 # HEYGEN (Avatar → Talking Video)
 # =========================
-def _heygen_headers():
+_HEYGEN_HEADERS = {"X-Api-Key": HEYGEN_KEY, "Content-Type": "application/json"}
+HEYGEN_CLIENT = _http_client("https://api.heygen.com", _HEYGEN_HEADERS)
+# parte fissa del body di /v2/video/generate: cambia solo video_inputs
+_HEYGEN_VIDEO_OPTS = {"test": False, "caption": False, "aspect_ratio": "9:16", "resolution": "720p"}
+
+def _heygen_client() -> httpx.AsyncClient:
     if not HEYGEN_KEY:
         raise HTTPException(500, "HEYGEN_API_KEY mancante")
-    return {"X-Api-Key": HEYGEN_KEY, "Content-Type": "application/json"}
+    return HEYGEN_CLIENT
 
+@lru_cache(maxsize=32)  # le eccezioni non vengono memorizzate: senza avatar continua a dare 500
 def _ensure_avatar(aid: Optional[str]) -> str:
     aid = aid or HEYGEN_AVATAR
     if not aid:
         raise HTTPException(500, "HEYGEN_AVATAR_ID mancante")
     return aid
 
-def heygen_submit_text(script: str, avatar_id: Optional[str] = None, voice_id: Optional[str] = None) -> str:
-    aid = _ensure_avatar(avatar_id)
-    payload = {
-        "video_inputs": [{
-            "avatar_id": aid,
-            "voice": {"type": "text", "input_text": script, "voice_id": (voice_id or HEYGEN_VOICE_ID)}
-        }],
-        "test": False, "caption": False, "aspect_ratio": "9:16", "resolution": "720p"
-    }
-    r = requests.post("https://api.heygen.com/v2/video/generate", headers=_heygen_headers(), json=payload, timeout=120)
+async def _heygen_submit(inputs: Dict[str, Any], what: str = "submit") -> str:
+    payload = {"video_inputs": [inputs], **_HEYGEN_VIDEO_OPTS}
+    r = await _heygen_client().post("/v2/video/generate", content=orjson.dumps(payload), timeout=120)
     if r.status_code != 200:
-        raise HTTPException(r.status_code, f"HeyGen v2 submit error: {r.text}")
+        raise HTTPException(r.status_code, f"HeyGen v2 {what} error: {_body_snippet(r)}")
     data = r.json().get("data", {})
     vid = data.get("video_id") or data.get("id")
     if not vid:
-        raise HTTPException(502, f"HeyGen v2: risposta senza video_id: {r.text}")
+        raise HTTPException(502, f"HeyGen v2: risposta senza video_id: {_body_snippet(r)}")
     return vid
 
-def heygen_submit_audio(audio_url: str, avatar_id: Optional[str] = None) -> str:
-    aid = _ensure_avatar(avatar_id)
-    payload = {
-        "video_inputs": [{
-            "avatar_id": aid,
-            "audio": {"type": "mp3", "source": "url", "url": audio_url}
-        }],
-        "test": False, "caption": False, "aspect_ratio": "9:16", "resolution": "720p"
-    }
-    r = requests.post("https://api.heygen.com/v2/video/generate", headers=_heygen_headers(), json=payload, timeout=120)
-    if r.status_code != 200:
-        raise HTTPException(r.status_code, f"HeyGen v2 submit-audio error: {r.text}")
-    data = r.json().get("data", {})
-    vid = data.get("video_id") or data.get("id")
-    if not vid:
-        raise HTTPException(502, f"HeyGen v2: risposta senza video_id: {r.text}")
-    return vid
-
-def heygen_status(video_id: str) -> Dict[str, Any]:
-    r = requests.get(f"https://api.heygen.com/v2/video/status?video_id={video_id}", headers=_heygen_headers(), timeout=60)
+async def heygen_submit_text(script: str, avatar_id: Optional[str] = None, voice_id: Optional[str] = None) -> str:
+    return await _heygen_submit({
+        "avatar_id": _ensure_avatar(avatar_id),
+        "voice": {"type": "text", "input_text": script, "voice_id": (voice_id or HEYGEN_VOICE_ID)},
+    })
+
+async def heygen_submit_audio(audio_url: str, avatar_id: Optional[str] = None) -> str:
+    return await _heygen_submit({
+        "avatar_id": _ensure_avatar(avatar_id),
+        "audio": {"type": "mp3", "source": "url", "url": audio_url},
+    }, "submit-audio")
+
+_HEYGEN_STATUS_PATHS = {"v2": "/v2/video/status", "v1": "/v1/video.status"}
+_HEYGEN_STATUS_VER = "v2"  # versione che ha risposto per ultima: si prova per prima
+_HEYGEN_STATUS_GONE = (404, 410)  # solo questi indicano endpoint sbagliato: gli altri errori non cambiano versione
+
+async def _heygen_status_fetch(video_id: str) -> Dict[str, Any]:
+    global _HEYGEN_STATUS_VER
+    params = {"video_id": video_id}
+    first = _HEYGEN_STATUS_VER
+    other = "v1" if first == "v2" else "v2"
+    r = await _heygen_client().get(_HEYGEN_STATUS_PATHS[first], params=params, timeout=60)
     if r.status_code == 200:
         return r.json()
-    r2 = requests.get(f"https://api.heygen.com/v1/video.status?video_id={video_id}", headers=_heygen_headers(), timeout=60)
+    if r.status_code not in _HEYGEN_STATUS_GONE:
+        raise HTTPException(502, f"HeyGen status error: {first}={r.status_code} {_body_snippet(r)}")
+    r2 = await _heygen_client().get(_HEYGEN_STATUS_PATHS[other], params=params, timeout=60)
     if r2.status_code == 200:
+        _HEYGEN_STATUS_VER = other
         return r2.json()
-    raise HTTPException(502, f"HeyGen status error: v2={r.status_code} {r.text} | v1={r2.status_code} {r2.text}")
-
-def poll_and_notify_heygen(video_id: str, to_email: Optional[str], order_name: Optional[str] = None,
-                           every_sec: int = 7, max_wait_sec: int = 1200):
-    _jobs_upsert(video_id, {"id": video_id, "provider": "heygen", "status": "queued",
-                            "to_email": to_email, "order_name": order_name})
-    waited = 0
-    while waited <= max_wait_sec:
+    raise HTTPException(502, f"HeyGen status error: {first}={r.status_code} {_body_snippet(r)} | "
+                             f"{other}={r2.status_code} {_body_snippet(r2)}")
+
+async def heygen_status(video_id: str) -> Dict[str, Any]:
+    return await _status_cached("heygen", video_id, _heygen_status_fetch)
+
+def _heygen_extract(s: Dict[str, Any]) -> Tuple[str, Optional[str], Any]:
+    data = s.get("data") or s
+    status = (data.get("status") or data.get("task_status") or "").lower()
+    video_url = (data.get("video") or {}).get("url") or data.get("video_url")
+    return status, video_url, data.get("error")
+
+# =========================
+# POLLER (scheduler unico: min-heap su "prossimo poll")
+# =========================
+# un solo ciclo di polling per tutti i provider: cambia solo come si legge lo stato
+POLL_PROVIDERS: Dict[str, Dict[str, Any]] = {
+    "d-id": {
+        "fetch": _did_status_fetch, "extract": _did_extract,
+        "done": frozenset({"done"}), "failed": frozenset({"error", "failed"}),
+        "label": "Video AI", "product": "Video Parlante AI", "max_wait_sec": 600,
+    },
+    "heygen": {
+        "fetch": _heygen_status_fetch, "extract": _heygen_extract,
+        "done": frozenset({"completed", "done", "succeeded"}), "failed": frozenset({"failed", "error", "canceled"}),
+        "label": "Video Avatar", "product": "Video Avatar", "max_wait_sec": 1200,
+    },
+}
+POLL_MIN_DELAY = 2
+POLL_MAX_DELAY = 30
+POLL_HOOK_MAX_DELAY = 60  # con i webhook attivi il poll serve solo se la notifica si perde
+
+POLL_QUEUE: List[Tuple[float, int, Dict[str, Any]]] = []  # (next_t, seq, entry)
+POLL_ACTIVE: Dict[str, Dict[str, Any]] = {}  # id -> entry dei job presenti in POLL_QUEUE
+_POLL_SEQ = itertools.count()
+_POLL_WAKE = asyncio.Event()
+# richieste di stato in volo per tick: un'ondata di job scaduti insieme non satura pool e provider
+POLL_CONCURRENCY = int(os.getenv("POLL_CONCURRENCY", "32"))
+_POLL_SEM = asyncio.Semaphore(POLL_CONCURRENCY)
+
+# Lease sulla riga del job: con più worker sullo stesso DB (gunicorn -w N) un job
+# viene interrogato da un solo processo; se quel processo muore il lease scade
+# e un altro worker lo prende in carico.
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+POLL_LEASE_SEC = 120
+
+POLL_ERR_ATTEMPT = 5  # dopo un errore si riparte dal tetto del backoff
+POLL_MAX_FAILS = int(os.getenv("POLL_MAX_FAILS", "10"))  # errori consecutivi prima di avvisare il cliente
+
+def _next_delay(attempt: int, cap: float = POLL_HOOK_MAX_DELAY if PUBLIC_BASE_URL else POLL_MAX_DELAY) -> float:
+    # backoff esponenziale con full jitter: i job partiti insieme si sparpagliano subito
+    return random.uniform(POLL_MIN_DELAY / 2, min(cap, POLL_MIN_DELAY * 2 ** min(attempt, POLL_ERR_ATTEMPT)))
+
+def poll_schedule(entry: Dict[str, Any], delay: float = 0.0):
+    # l'entry ricorda l'ultimo seq: se viene rischedulata prima del tempo, la voce vecchia nell'heap si salta
+    entry["seq"] = seq = next(_POLL_SEQ)
+    entry["next_t"] = t = time.monotonic() + delay
+    heapq.heappush(POLL_QUEUE, (t, seq, entry))
+    _POLL_WAKE.set()
+
+def _poll_wake_entry(entry: Dict[str, Any]):
+    _STATUS_CACHE.pop((entry["provider"], entry["id"]), None)
+    entry["attempt"] = 0
+    if entry["seq"] is not None and entry["next_t"] - time.monotonic() > POLL_MIN_DELAY:
+        poll_schedule(entry)
+
+def _storage_wake(job_id: str) -> bool:
+    if DB is None:
+        return False
+    try:
+        with DB_LOCK:
+            cur = DB.execute("UPDATE jobs SET wake_at=? WHERE id=? AND json_extract(payload, '$.polling')",
+                             (time.time(), job_id))
+    except Exception as e:
+        log.warning("⚠️ lease error: %s", e)
+        return False
+    return cur.rowcount > 0
+
+async def poll_wake(job_id: str) -> bool:
+    # notifica del provider: anticipa il prossimo poll, lo stato vero lo rilegge comunque il poller
+    entry = POLL_ACTIVE.get(job_id)
+    if entry is not None:
+        _poll_wake_entry(entry)
+        return True
+    # il job lo segue un altro worker: la sveglia resta sulla riga e la raccoglie poll_take_wakes
+    return await asyncio.to_thread(_storage_wake, job_id)
+
+def poll_take_wakes():
+    # sveglie lasciate sulle righe dei nostri job dai webhook arrivati agli altri worker
+    if DB is None:
+        return
+    try:
+        with DB_LOCK:
+            rows = DB.execute("SELECT id, wake_at FROM jobs WHERE lease_owner=? AND wake_at IS NOT NULL",
+                              (WORKER_ID,)).fetchall()
+            if rows:
+                # solo quelle lette: una sveglia arrivata nel frattempo resta per il giro dopo
+                DB.execute("UPDATE jobs SET wake_at=NULL WHERE lease_owner=? AND wake_at <= ?",
+                           (WORKER_ID, max(w for _, w in rows)))
+    except Exception as e:
+        log.warning("⚠️ lease error: %s", e)
+        return
+    for job_id, _ in rows:
+        entry = POLL_ACTIVE.get(job_id)
+        if entry is not None:
+            _poll_wake_entry(entry)
+
+def poll_enqueue(job_id: str, provider: str, to_email: Optional[str], order_name: Optional[str],
+                 notified: bool = False):
+    if job_id in POLL_ACTIVE:
+        return
+    # polling: True è già sul job (scritto da chi lo crea, o letto dal DB per resume/adopt)
+    spec = POLL_PROVIDERS[provider]
+    entry = {"id": job_id, "provider": provider, "to_email": to_email, "order_name": order_name,
+             "deadline": time.monotonic() + spec["max_wait_sec"], "attempt": 0, "notified": notified}
+    POLL_ACTIVE[job_id] = entry
+    poll_schedule(entry, POLL_MIN_DELAY)
+
+async def _poll_timeout(entry: Dict[str, Any]):
+    # un solo avviso per job, anche tra un riavvio e l'altro
+    if entry.get("to_email") and not entry.get("notified"):
+        entry["notified"] = True
         try:
-            s = heygen_status(video_id)
-        except HTTPException as e:
-            _jobs_upsert(video_id, {"status": f"error:{e.status_code}", "raw": str(e.detail)})
-            time.sleep(every_sec); waited += every_sec
-            continue
-        data = s.get("data") or s
-        status = (data.get("status") or data.get("task_status") or "").lower()
-        video_url = (data.get("video") or {}).get("url") or data.get("video_url")
-        _jobs_upsert(video_id, {"status": status, "video_url": video_url, "raw": s})
-        if status in {"completed", "done", "succeeded"} and video_url:
-            if to_email:
-                html = (
-                    '<p>Ciao! 👋</p><p>Il tuo <b>Video Avatar</b> è pronto.</p>'
-                    f'<p><a href="{video_url}" target="_blank">Scarica il video</a></p>'
-                )
-                send_email(to_email, f"Video Avatar pronto — Ordine {order_name or ''}", html)
-            return
-        if status in {"failed", "error", "canceled"}:
-            if to_email:
-                send_email(to_email, f"Problema con il tuo Video Avatar — Ordine {order_name or ''}",
-                           "<p>Si è verificato un errore. Ti contatteremo a breve.</p>")
-            return
-        time.sleep(every_sec); waited += every_sec
-    if to_email:
-        send_email(to_email, f"Stiamo completando il tuo Video Avatar — Ordine {order_name or ''}",
+            await _jobs_save(entry["id"], {"delay_notified": True})
+        except Exception:
+            pass  # già loggato: l'avviso parte comunque, il flag resta solo in memoria
+        label = POLL_PROVIDERS[entry["provider"]]["label"]
+        send_email(entry["to_email"],
+                   f"Stiamo completando il tuo {label} — Ordine {entry.get('order_name') or ''}",
                    "<p>La generazione richiede più tempo del previsto. Ti avviseremo appena pronto.</p>")
 
+def poll_resume():
+    # job rimasti a metà prima di un riavvio: riprendono il polling
+    pending = [j for j in _storage_polling() if j.get("provider") in POLL_PROVIDERS]
+    for j in pending:
+        poll_enqueue(j["id"], j["provider"], j.get("to_email"), j.get("order_name"), bool(j.get("delay_notified")))
+
+def _poll_claim(job_id: str) -> Optional[bool]:
+    # True = lease ottenuto/rinnovato, False = lo tiene un altro worker, None = polling concluso
+    if DB is None:
+        return True
+    now = time.time()
+    try:
+        with DB_LOCK:
+            cur = DB.execute(
+                "UPDATE jobs SET lease_owner=?, lease_until=? WHERE id=?"
+                " AND json_extract(payload, '$.polling')"
+                " AND (lease_owner IS NULL OR lease_owner=? OR lease_until < ?)",
+                (WORKER_ID, now + POLL_LEASE_SEC, job_id, WORKER_ID, now),
+            )
+            if cur.rowcount:
+                return True
+            row = DB.execute("SELECT json_extract(payload, '$.polling') FROM jobs WHERE id=?", (job_id,)).fetchone()
+    except Exception as e:
+        log.warning("⚠️ lease error: %s", e)
+        return True
+    return False if row and row[0] else None
+
+def poll_adopt_orphans():
+    # job ancora in polling con lease scaduto: il worker che li seguiva è morto
+    if DB is None:
+        return
+    try:
+        with DB_LOCK:
+            rows = DB.execute(
+                "SELECT payload FROM jobs WHERE json_extract(payload, '$.polling')"
+                " AND lease_until IS NOT NULL AND lease_until < ?", (time.time(),)
+            ).fetchall()
+    except Exception as e:
+        log.warning("⚠️ lease error: %s", e)
+        return
+    for (payload,) in rows:
+        j = orjson.loads(payload)
+        if j["id"] in POLL_ACTIVE or j.get("provider") not in POLL_PROVIDERS:
+            continue
+        lk, _ = _shard(j["id"])
+        with lk:
+            _jobs_put(j["id"], j)
+        log.info("poll: riprendo %s (lease scaduto)", j["id"])
+        poll_enqueue(j["id"], j["provider"], j.get("to_email"), j.get("order_name"), bool(j.get("delay_notified")))
+
+async def _poll_record(entry: Dict[str, Any], status: str, video_url: Optional[str], error: Any = None):
+    # scrive solo quando stato/URL cambiano; della risposta del provider teniamo il minimo
+    key = (status, video_url)
+    if entry.get("last") == key:
+        return
+    await _jobs_save(entry["id"], {"status": status, "video_url": video_url,
+                                   "raw": {"status": status, "error": error}})
+    entry["last"] = key  # solo a scrittura riuscita: se il DB fallisce si riscrive al giro dopo
+    entry["attempt"] = 0  # stato cambiato: il provider si sta muovendo, si torna a interrogare spesso
+
+async def poll_step(entry: Dict[str, Any]) -> bool:
+    spec = POLL_PROVIDERS[entry["provider"]]
+    job_id, to_email, order_name = entry["id"], entry.get("to_email"), entry.get("order_name")
+    try:
+        s = await spec["fetch"](job_id)
+    except HTTPException as e:
+        entry.pop("last", None)
+        await _jobs_save(job_id, {"status": f"error:{e.status_code}", "raw": str(e.detail)})
+        raise
+    except httpx.HTTPError as e:
+        entry.pop("last", None)
+        await _jobs_save(job_id, {"status": "error:network", "raw": str(e)})
+        raise
+    _status_store(entry["provider"], job_id, s)
+    status, video_url, error = spec["extract"](s)
+    await _poll_record(entry, status, video_url, error)
+    if status in spec["done"] and video_url:
+        if to_email:
+            html = (
+                f'<p>Ciao! 👋</p><p>Il tuo <b>{spec["product"]}</b> è pronto.</p>'
+                f'<p><a href="{video_url}" target="_blank">Scarica il video</a></p>'
+            )
+            send_email(to_email, f"{spec['label']} pronto — Ordine {order_name or ''}", html)
+        return True
+    if status in spec["failed"]:
+        if to_email:
+            send_email(to_email, f"Problema con il tuo {spec['label']} — Ordine {order_name or ''}",
+                       "<p>Si è verificato un errore. Ti contatteremo a breve.</p>")
+        return True
+    return False
+
+async def _poll_step(entry: Dict[str, Any]) -> bool:
+    if entry.get("closing"):
+        return True  # esito già gestito (email comprese): manca solo polling=False nel DB
+    async with _POLL_SEM:
+        return await poll_step(entry)
+
+async def _poll_close(entry: Dict[str, Any]):
+    try:
+        await _jobs_save(entry["id"], {"polling": False})
+    except Exception:
+        # DB occupato: si riprova al prossimo giro senza interrogare il provider né rimandare email
+        entry["closing"] = True
+        poll_schedule(entry, POLL_MIN_DELAY)
+        return
+    POLL_ACTIVE.pop(entry["id"], None)
+    _STATUS_CACHE.pop((entry["provider"], entry["id"]), None)
+
+async def poll_worker():
+    next_sweep = time.monotonic() + POLL_LEASE_SEC
+    next_wakes = time.monotonic() + POLL_MIN_DELAY
+    while True:
+        now = time.monotonic()
+        if now >= next_sweep:
+            poll_adopt_orphans()
+            next_sweep = now + POLL_LEASE_SEC
+        if now >= next_wakes:
+            if POLL_ACTIVE:
+                poll_take_wakes()
+            next_wakes = now + POLL_MIN_DELAY
+        batch = []
+        while POLL_QUEUE and POLL_QUEUE[0][0] <= now:
+            _, seq, entry = heapq.heappop(POLL_QUEUE)
+            if seq != entry["seq"]:
+                continue  # rischedulata nel frattempo (webhook)
+            entry["seq"] = None  # in volo
+            claim = _poll_claim(entry["id"])
+            if claim:
+                batch.append(entry)
+            elif claim is False:
+                poll_schedule(entry, POLL_MAX_DELAY)
+            else:
+                POLL_ACTIVE.pop(entry["id"], None)
+        if not batch:
+            _POLL_WAKE.clear()
+            next_t = min(POLL_QUEUE[0][0], next_sweep) if POLL_QUEUE else next_sweep
+            if DB is not None and POLL_ACTIVE:
+                next_t = min(next_t, next_wakes)
+            try:
+                await asyncio.wait_for(_POLL_WAKE.wait(), max(next_t - time.monotonic(), 0))
+            except asyncio.TimeoutError:
+                pass
+            continue
+        log.debug("poll tick: %d job", len(batch))
+        results = await asyncio.gather(*(_poll_step(e) for e in batch), return_exceptions=True)
+        for entry, done in zip(batch, results):
+            if isinstance(done, Exception):
+                # provider in errore: niente retry ravvicinati, si riparte dal tetto
+                log.warning("⚠️ poll error: %s %r", entry["id"], done)
+                entry["attempt"] = POLL_ERR_ATTEMPT
+                entry["fails"] = entry.get("fails", 0) + 1
+                done = False
+            else:
+                entry["fails"] = 0
+            if done:
+                await _poll_close(entry)
+                continue
+            if time.monotonic() > entry["deadline"]:
+                await _poll_timeout(entry)
+                await _poll_close(entry)
+                continue
+            if entry.get("fails", 0) >= POLL_MAX_FAILS:
+                # provider giù da troppo: il video è già pagato, quindi si avvisa il cliente una volta
+                # e si continua a interrogare al tetto del backoff fino alla scadenza
+                if entry["fails"] == POLL_MAX_FAILS:
+                    log.error("❌ poll: %d errori di fila per %s, continuo al tetto", entry["fails"], entry["id"])
+                await _poll_timeout(entry)
+                poll_schedule(entry, POLL_HOOK_MAX_DELAY if PUBLIC_BASE_URL else POLL_MAX_DELAY)
+                continue
+            poll_schedule(entry, _next_delay(entry["attempt"]))
+            entry["attempt"] += 1
+
 # =========================
 # META & DIAG
 # =========================
@@ -340,7 +1063,8 @@ def diag_env():
         "ELEVENLABS_API_KEY": bool(ELEVEN_KEY),
         "ADMIN_TOKEN": bool(ADMIN_TOKEN),
         "SHOP_DOMAIN": SHOP_DOMAIN, "SHOP_ADMIN_TOKEN": bool(SHOP_ADMIN_TOKEN),
-        "DATA_FILE": DATA_FILE,
+        "DEBUG": DEBUG, "PUBLIC_BASE_URL": PUBLIC_BASE_URL, "DATA_FILE": DATA_FILE, "DB_FILE": DB_FILE, "DB_OK": DB is not None,
+        "STATUS_TTL": STATUS_TTL, "STATUS_CACHE": {**STATUS_CACHE_STATS, "size": len(_STATUS_CACHE)},
     }
 
 # =========================
@@ -348,60 +1072,135 @@ def diag_env():
 # =========================
 @app.post("/api/jobs/photo")
 @app.post("/api/jobs")  # compat
-def create_job_photo(job: Job, bg: BackgroundTasks):
-    talk = did_create_talk(job)
+async def create_job_photo(job: Job):
+    talk = await did_create_talk(job)
     talk_id = talk.get("id")
     if talk_id:
-        _jobs_upsert(talk_id, {"id": talk_id, "provider": "d-id", "status": "submitted",
-                               "to_email": job.to_email, "order_name": job.order_name, "raw": talk})
-        bg.add_task(poll_and_notify_did, job, talk_id)
+        await _jobs_save(talk_id, {"id": talk_id, "provider": "d-id", "status": "submitted", "polling": True,
+                                   "to_email": job.to_email, "order_name": job.order_name, "raw": talk})
+        poll_enqueue(talk_id, "d-id", job.to_email, job.order_name)
     return {"ok": True, "provider": "d-id", "talk_id": talk_id, "raw": talk}
 
 # =========================
 # PIPELINE HEYGEN: API
 # =========================
 @app.post("/api/heygen/submit")
-def heygen_submit_endpoint(body: HeygenText, bg: BackgroundTasks):
-    vid = heygen_submit_text(body.script, body.avatar_id, body.voice_id)
-    _jobs_upsert(vid, {"id": vid, "provider": "heygen", "status": "submitted",
-                       "to_email": body.to_email, "order_name": body.order_name})
+async def heygen_submit_endpoint(body: HeygenText):
+    vid = await heygen_submit_text(body.script, body.avatar_id, body.voice_id)
+    await _jobs_save(vid, {"id": vid, "provider": "heygen", "status": "submitted", "polling": bool(body.to_email),
+                           "to_email": body.to_email, "order_name": body.order_name})
     if body.to_email:
-        bg.add_task(poll_and_notify_heygen, vid, body.to_email, body.order_name)
+        poll_enqueue(vid, "heygen", body.to_email, body.order_name)
     return {"ok": True, "provider": "heygen", "video_id": vid}
 
 @app.post("/api/heygen/submit-audio")
-def heygen_submit_audio_endpoint(body: HeygenAudio, bg: BackgroundTasks):
-    vid = heygen_submit_audio(body.audio_url, body.avatar_id)
-    _jobs_upsert(vid, {"id": vid, "provider": "heygen", "status": "submitted",
-                       "to_email": body.to_email, "order_name": body.order_name})
+async def heygen_submit_audio_endpoint(body: HeygenAudio):
+    vid = await heygen_submit_audio(body.audio_url, body.avatar_id)
+    await _jobs_save(vid, {"id": vid, "provider": "heygen", "status": "submitted", "polling": bool(body.to_email),
+                           "to_email": body.to_email, "order_name": body.order_name})
     if body.to_email:
-        bg.add_task(poll_and_notify_heygen, vid, body.to_email, body.order_name)
+        poll_enqueue(vid, "heygen", body.to_email, body.order_name)
     return {"ok": True, "provider": "heygen", "video_id": vid}
 
 @app.get("/api/heygen/status")
-def heygen_status_endpoint(video_id: str = Query(..., min_length=4)):
+async def heygen_status_endpoint(video_id: str = Query(..., min_length=4)):
     if video_id in {"INSERISCI_ID", "QUI_IL_VIDEO_ID"}:
         raise HTTPException(400, "video_id è un placeholder: usa l’ID reale restituito da /api/heygen/submit")
-    return heygen_status(video_id)
+    return await heygen_status(video_id)
+
+# =========================
+# WEBHOOK PROVIDER (D-ID: campo "webhook" nel payload; HeyGen: endpoint registrato sull'account)
+# =========================
+async def _hook_body(request: Request) -> Dict[str, Any]:
+    try:
+        d = orjson.loads(await request.body())
+    except orjson.JSONDecodeError:
+        raise HTTPException(400, "Body JSON non valido")
+    return d if isinstance(d, dict) else {}
+
+@app.post("/api/hooks/did")
+async def did_hook(request: Request):
+    d = await _hook_body(request)
+    return {"ok": True, "polling": await poll_wake(str(d.get("id") or ""))}
+
+@app.post("/api/hooks/heygen")
+async def heygen_hook(request: Request):
+    d = await _hook_body(request)
+    ev = d.get("event_data") or {}
+    return {"ok": True, "polling": await poll_wake(str(ev.get("video_id") or d.get("video_id") or ""))}
 
 # =========================
 # ADMIN API (Bearer)
 # =========================
+_JOBS_SNAPSHOTS: Dict[Optional[int], Tuple[int, str, bytes]] = {}  # limit -> (versione, ETag, body JSON)
+
 @app.get("/api/admin/jobs")
-def admin_jobs(_: bool = Depends(require_admin_header)):
-    return {"ok": True, "jobs": _jobs_list()}
+def admin_jobs(request: Request, limit: Optional[int] = Query(None, ge=1), since: Optional[int] = Query(None, ge=0),
+               _: bool = Depends(require_admin_header)):
+    if since is not None:
+        # refresh incrementale: solo i job cambiati dopo il cursore (di solito nessuno)
+        changed = _jobs_since(since)
+        cursor = changed[0].get("updated_at_ns", since) if changed else since
+        return {"ok": True, "jobs": [_job_view(j) for j in changed], "cursor": str(cursor)}
+    # il cursore (ns) viaggia come stringa: in JS un intero così grande perderebbe precisione
+    # la lista si serializza solo quando la versione cambia; i refresh senza novità ricevono 304
+    ver = _jobs_version()
+    snap = _JOBS_SNAPSHOTS.get(limit)
+    if snap is None or snap[0] != ver:
+        jobs = _jobs_list(limit)
+        cursor = jobs[0].get("updated_at_ns", 0) if jobs else 0
+        body = orjson.dumps({"ok": True, "jobs": [_job_view(j) for j in jobs], "cursor": str(cursor)})
+        snap = (ver, 'W/"%s"' % hashlib.blake2b(body, digest_size=16).hexdigest(), body)
+        if len(_JOBS_SNAPSHOTS) >= 8:
+            _JOBS_SNAPSHOTS.clear()
+        _JOBS_SNAPSHOTS[limit] = snap
+    _, etag, body = snap
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    return Response(body, media_type="application/json", headers={"ETag": etag})
+
+SSE_TICK_SEC = 1.0
+SSE_PING_SEC = 15.0
+
+@app.get("/api/admin/jobs/stream")
+async def admin_jobs_stream(request: Request, token: str = Query("")):
+    # EventSource non può mandare header: il token arriva in query
+    if not ADMIN_TOKEN:
+        raise HTTPException(500, "ADMIN_TOKEN non configurato")
+    if not token or _admin_auth_error(f"Bearer {token}"):
+        raise HTTPException(401, "Unauthorized")
+
+    async def events():
+        # primo evento: lista completa; poi solo i job aggiornati dopo il cursore
+        ver, cursor, idle = -1, 0, 0.0
+        while not await request.is_disconnected():
+            v = await asyncio.to_thread(_jobs_version)
+            if v != ver:
+                ver = v
+                changed = await asyncio.to_thread(_jobs_since, cursor)
+                if changed or not cursor:
+                    msg = {"full": not cursor, "jobs": [_job_view(j) for j in changed]}
+                    cursor = max(cursor, changed[0].get("updated_at_ns", 0) if changed else 1)
+                    idle = 0.0
+                    yield b"data: " + orjson.dumps(msg) + b"\n\n"
+            if idle >= SSE_PING_SEC:
+                idle = 0.0
+                yield b": ping\n\n"
+            await asyncio.sleep(SSE_TICK_SEC)
+            idle += SSE_TICK_SEC
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 @app.get("/api/admin/jobs/{job_id}")
 def admin_job_detail(job_id: str, _: bool = Depends(require_admin_header)):
-    with JOBS_LOCK:
-        j = JOBS.get(job_id)
+    j = _jobs_get(job_id)
     if not j: raise HTTPException(404, "Job not found")
-    return {"ok": True, "job": j}
+    return {"ok": True, "job": _job_view(j)}
 
 @app.post("/api/admin/resend-email/{job_id}")
-def admin_resend_email(job_id: str, _: bool = Depends(require_admin_header)):
-    with JOBS_LOCK:
-        j = JOBS.get(job_id)
+async def admin_resend_email(job_id: str, _: bool = Depends(require_admin_header)):
+    j = _jobs_get(job_id)
     if not j: raise HTTPException(404, "Job not found")
     if not j.get("to_email"): raise HTTPException(400, "Job senza email")
     if not j.get("video_url"): raise HTTPException(400, "Video non pronto")
@@ -415,16 +1214,21 @@ def admin_resend_email(job_id: str, _: bool = Depends(require_admin_header)):
 # =========================
 # SHOPIFY: CREATE PRODUCT
 # =========================
-def _shop_headers():
-    if not (SHOP_DOMAIN and SHOP_ADMIN_TOKEN):
+SHOP_CLIENT = _http_client(f"https://{SHOP_DOMAIN}/admin/api/{SHOPIFY_API_VER}", {
+    "X-Shopify-Access-Token": SHOP_ADMIN_TOKEN,
+    "Content-Type": "application/json",
+    "Accept": "application/json",
+}) if SHOP_DOMAIN else None
+# 429/503 = richiesta non elaborata: si può ripetere anche il POST (rispettando Retry-After)
+SHOP_RETRY_STATUS = (429, 503)
+SHOP_RETRIES = 3
+
+def _shop_client() -> httpx.AsyncClient:
+    if not (SHOP_CLIENT and SHOP_ADMIN_TOKEN):
         raise HTTPException(500, "SHOP_DOMAIN/SHOP_ADMIN_TOKEN mancanti")
-    return {
-        "X-Shopify-Access-Token": SHOP_ADMIN_TOKEN,
-        "Content-Type": "application/json",
-        "Accept": "application/json",
-    }
+    return SHOP_CLIENT
 
-def shopify_create_product(title: str, body_html: str, price: float, image_url: Optional[str] = None,
+async def shopify_create_product(title: str, body_html: str, price: float, image_url: Optional[str] = None,
                            published: bool = True, tags: Optional[List[str]] = None) -> Dict[str, Any]:
     payload = {
         "product": {
@@ -437,17 +1241,20 @@ def shopify_create_product(title: str, body_html: str, price: float, image_url:
     }
     if image_url:
         payload["product"]["images"] = [{"src": image_url}]
-    url = f"https://{SHOP_DOMAIN}/admin/api/{SHOPIFY_API_VER}/products.json"
-    r = requests.post(url, headers=_shop_headers(), json=payload, timeout=60)
+    body = orjson.dumps(payload)
+    for attempt in range(SHOP_RETRIES + 1):
+        r = await _shop_client().post("/products.json", content=body, timeout=60)
+        if r.status_code not in SHOP_RETRY_STATUS or attempt == SHOP_RETRIES:
+            break
+        await asyncio.sleep(_retry_after(r, attempt))
     if r.status_code not in (200, 201):
-        raise HTTPException(r.status_code, f"Shopify create product error: {r.text}")
+        raise HTTPException(r.status_code, f"Shopify create product error: {_body_snippet(r)}")
     return r.json()
 
 @app.post("/api/admin/publish/{job_id}")
-def admin_publish(job_id: str, price: float = 19.0, published: bool = True,
-                  _: bool = Depends(require_admin_header)):
-    with JOBS_LOCK:
-        j = JOBS.get(job_id)
+async def admin_publish(job_id: str, price: float = 19.0, published: bool = True,
+                        _: bool = Depends(require_admin_header)):
+    j = _jobs_get(job_id)
     if not j: raise HTTPException(404, "Job not found")
     if not j.get("video_url"): raise HTTPException(400, "Video non pronto")
 
@@ -459,23 +1266,17 @@ def admin_publish(job_id: str, price: float = 19.0, published: bool = True,
     body_html = "\n".join(desc)
 
     img = j.get("thumbnail") or None  # puoi valorizzarlo in futuro
-    res = shopify_create_product(title=title, body_html=body_html, price=price, image_url=img, published=published)
+    res = await shopify_create_product(title=title, body_html=body_html, price=price, image_url=img, published=published)
     prod = (res or {}).get("product") or {}
     handle = prod.get("handle"); pid = prod.get("id")
     url = f"https://www.eccomionline.com/products/{handle}" if handle else ""
-    _jobs_upsert(job_id, {"shopify_product_id": pid, "shopify_url": url})
+    await _jobs_save(job_id, {"shopify_product_id": pid, "shopify_url": url})
     return {"ok": True, "product_id": pid, "product_url": url}
 
 # =========================
 # DASHBOARD + CREATOR PANEL
 # =========================
-@app.get("/dashboard", response_class=HTMLResponse)
-def dashboard_page():
-    return """
-<!doctype html><html lang="it"><meta charset="utf-8"/>
-<meta name="viewport" content="width=device-width,initial-scale=1"/>
-<title>Eccomi Video — Dashboard</title>
-<style>
+DASHBOARD_CSS = """
 body{font-family:system-ui,Inter,sans-serif;margin:24px;max-width:1100px}
 h1{margin:0 0 12px}
 section{margin:16px 0;padding:12px;border:1px solid #e5e7eb;border-radius:8px;background:#fafafa}
@@ -489,14 +1290,316 @@ input,select,textarea{width:100%;padding:8px;border:1px solid #ddd;border-radius
 table{border-collapse:collapse;width:100%;margin-top:12px}
 td,th{border:1px solid #e5e7eb;padding:8px;font-size:14px;vertical-align:top}
 tr:hover{background:#fafafa}
+#jobs-wrap{max-height:70vh;overflow:auto}
+tr.spacer td{padding:0;border:0}
+/* un solo attributo sul creator decide quale gruppo di campi si vede */
+.only-did,.only-hg-text,.only-hg-audio{display:none}
+#creator[data-mode="did-photo"] .only-did,#creator[data-mode="hg-text"] .only-hg-text,
+#creator[data-mode="hg-audio"] .only-hg-audio{display:block}
+#toast{position:fixed;right:24px;bottom:24px;padding:10px 14px;border-radius:8px;background:#111;color:#fff;display:none}
+#toast.err{background:crimson}
 small{color:#666}
 hr{border:none;border-top:1px solid #eee;margin:12px 0}
-</style>
+"""
+
+DASHBOARD_JS = """
+function askToken(){
+  let tk = new URLSearchParams(location.search).get("token");
+  if(!tk) tk = sessionStorage.getItem("eccomi_admin_token") || "";
+  if(!tk){ tk = prompt("Inserisci ADMIN_TOKEN"); }
+  if(!tk){ document.body.innerHTML = "<p>Token mancante.</p>"; return null; }
+  sessionStorage.setItem("eccomi_admin_token", tk);
+  return tk;
+}
+const token = askToken(); if(!token) throw new Error("No token");
+
+// toggle campi
+const selType = document.getElementById('type');
+const creator = document.getElementById('creator');
+function updateFields(){ creator.dataset.mode = selType.value; }
+selType.onchange = updateFields; updateFields();
+// riferimenti presi una volta sola: il DOM della pagina non cambia
+const els = Object.fromEntries(['image_url','voice','script','audio_url','hg_script','hg_avatar','hg_voice',
+  'hg_audio_url','hg_avatar2','order_name','to_email','msg','create','refresh','live','toast','priceDialog','priceInput'].map(id => [id, document.getElementById(id)]));
+
+let jobsEtag = "", cursor = null, loadCtrl = null;
+const jobsById = new Map();
+async function load(){
+  // una richiesta viva alla volta: la precedente si annulla, e dopo 10s si lascia perdere
+  if(loadCtrl) loadCtrl.abort();
+  const ctrl = loadCtrl = new AbortController();
+  const timer = setTimeout(()=> ctrl.abort(), 10000);
+  // dopo la prima lista completa si chiedono solo i job cambiati dopo il cursore
+  const h = { Authorization:`Bearer ${token}` };
+  if(cursor === null && jobsEtag) h["If-None-Match"] = jobsEtag;
+  const url = '/api/admin/jobs' + (cursor !== null ? `?since=${encodeURIComponent(cursor)}` : '');
+  try {
+    const r = await fetch(url, { headers:h, cache:"no-store", signal:ctrl.signal });
+    if(r.status === 304) return; // niente di nuovo: la tabella resta com'è
+    if(!r.ok){ document.body.innerHTML = "<p>Unauthorized</p>"; return; }
+    const data = await r.json();
+    if(cursor === null) jobsEtag = r.headers.get("ETag") || "";
+    applyDelta({ full:cursor === null, jobs:data.jobs });
+    cursor = data.cursor;
+  } catch(e){
+    if(e.name !== "AbortError") throw e;
+  } finally {
+    clearTimeout(timer);
+    if(loadCtrl === ctrl) loadCtrl = null;
+  }
+}
+function applyDelta(d){
+  if(d.full) jobsById.clear();
+  for(const j of (d.jobs||[])) jobsById.set(j.id, j);
+  schedule(render);
+}
+// le scritture sul DOM partono al massimo una volta per frame: risposte, eventi SSE e scroll
+// arrivati nello stesso frame producono un solo paint
+let frame = 0, frameJob = null;
+function schedule(fn){
+  if(frameJob !== render) frameJob = fn; // render include già paint
+  if(!frame) frame = requestAnimationFrame(()=>{ const f = frameJob; frame = 0; frameJob = null; f(); });
+}
+// righe già nel DOM per id: si riscrivono solo quelle cambiate, le altre al massimo si spostano
+const rowCache = new Map();
+function sig(j){
+  return [j.id, j.provider, j.status, j.video_url, j.to_email, j.order_name, j.updated_at, j.shopify_url].join('|');
+}
+// celle costruite con nodi e textContent: nessun dato del job passa dal parser HTML
+function el(tag, props, ...kids){
+  const n = Object.assign(document.createElement(tag), props);
+  n.append(...kids);
+  return n;
+}
+function link(href, text, className=""){
+  return /^https?:/i.test(href||"") ? el("a", { href, target:"_blank", textContent:text, className }) : "";
+}
+function actionBtn(action, id, text, enabled){
+  const b = el("button", { className:"btn", textContent:text, disabled:!enabled });
+  if(enabled){ b.dataset.action = action; b.dataset.id = id; }
+  return b;
+}
+function fillRow(tr, j){
+  const td = (...kids)=> el("td", {}, ...kids);
+  tr.replaceChildren(
+    td(el("code", { textContent:j.id||"" }), el("br"), el("small", { textContent:j.updated_at||"" })),
+    td(j.provider||""),
+    td(el("span", { className:"badge", textContent:j.status||"" })),
+    td(j.video_url ? link(j.video_url, "apri") : ""),
+    td(j.to_email||""),
+    td(j.order_name||""),
+    td(actionBtn("publish", j.id, "Pubblica", !!j.video_url), " ",
+       actionBtn("resend", j.id, "Re-invia email", !!j.video_url), " ",
+       j.shopify_url ? link(j.shopify_url, "Prodotto", "btn") : ""),
+  );
+}
+// sopra VIRT_MIN righe si montano solo quelle visibili (+ OVERSCAN), il resto è uno spacer
+const VIRT_MIN = 50, OVERSCAN = 10;
+const wrap = document.getElementById("jobs-wrap");
+const tbody = document.querySelector("#jobs tbody");
+function spacer(){
+  const tr = document.createElement("tr"); tr.className = "spacer";
+  tr.innerHTML = '<td colspan="7"></td>';
+  return tr;
+}
+const topPad = spacer(), bottomPad = spacer();
+tbody.append(topPad, bottomPad);
+let sorted = [], rowH = 0;
+function render(){
+  sorted = [...jobsById.values()].sort((a,b)=> Date.parse(b.updated_at||0) - Date.parse(a.updated_at||0));
+  for(const [id, tr] of rowCache){
+    if(!jobsById.has(id)){ tr.remove(); rowCache.delete(id); }
+  }
+  paint();
+}
+function paint(){
+  let start = 0, end = sorted.length;
+  if(sorted.length >= VIRT_MIN && rowH){
+    start = Math.max(0, Math.floor(wrap.scrollTop/rowH) - OVERSCAN);
+    end = Math.min(sorted.length, Math.ceil((wrap.scrollTop + wrap.clientHeight)/rowH) + OVERSCAN);
+  }
+  const rows = [];
+  let mounted = 0;
+  for(let i = start; i < end; i++){
+    const j = sorted[i];
+    let tr = rowCache.get(j.id);
+    if(!tr){ tr = document.createElement("tr"); rowCache.set(j.id, tr); }
+    const s = sig(j);
+    if(tr.dataset.sig !== s){ fillRow(tr, j); tr.dataset.sig = s; }
+    if(tr.parentNode) mounted++;
+    rows.push(tr);
+  }
+  if(!mounted){
+    // primo caricamento o salto di scroll: tutte le righe in un fragment, un solo inserimento
+    const frag = document.createDocumentFragment();
+    frag.append(topPad, ...rows, bottomPad);
+    tbody.replaceChildren(frag);
+  } else {
+    const visible = new Set(rows);
+    for(const tr of rowCache.values()){
+      if(tr.parentNode && !visible.has(tr)) tr.remove();
+    }
+    let prev = topPad;
+    for(const tr of rows){
+      if(prev.nextSibling !== tr) tbody.insertBefore(tr, prev.nextSibling);
+      prev = tr;
+    }
+  }
+  const prev = rows[rows.length-1];
+  // altezza riga stimata una volta dalla prima riga montata
+  if(!rowH && prev){
+    rowH = prev.offsetHeight || 0;
+    if(rowH && sorted.length >= VIRT_MIN) return paint();
+  }
+  topPad.firstChild.style.height = (start*rowH) + "px";
+  bottomPad.firstChild.style.height = ((sorted.length-end)*rowH) + "px";
+}
+wrap.addEventListener("scroll", ()=>{ if(sorted.length >= VIRT_MIN) schedule(paint); }, { passive:true });
+// una sola richiesta alla volta e al massimo una ogni 2s (click ripetuti, errori SSE a raffica)
+let lastLoad = 0, inflight = null;
+function safeLoad(){
+  if(inflight) return inflight;
+  const now = Date.now();
+  if(now - lastLoad < 2000) return;
+  lastLoad = now;
+  inflight = load().finally(()=>{ inflight = null; });
+  return inflight;
+}
+els.refresh.onclick = (e)=>{ e.preventDefault(); safeLoad(); };
+// aggiornamenti in push (SSE); il polling resta solo per i browser senza EventSource
+if(window.EventSource){
+  const es = new EventSource('/api/admin/jobs/stream?token=' + encodeURIComponent(token));
+  es.onmessage = (e)=> applyDelta(JSON.parse(e.data));
+  es.onerror = ()=> safeLoad();
+} else {
+  els.live.textContent = "Auto-refresh 6s";
+  setInterval(()=>{ if(document.visibilityState === 'visible') safeLoad(); }, 6000);
+  document.addEventListener('visibilitychange', ()=>{ if(document.visibilityState === 'visible') safeLoad(); });
+  safeLoad();
+}
+
+// niente prompt()/alert(): bloccherebbero il thread (e con lui SSE, polling e paint)
+let toastTimer = 0;
+function showToast(text, ok=true){
+  els.toast.textContent = text;
+  els.toast.className = ok ? "" : "err";
+  els.toast.style.display = "block";
+  clearTimeout(toastTimer);
+  toastTimer = setTimeout(()=>{ els.toast.style.display = "none"; }, 3000);
+}
+function askPrice(){
+  return new Promise(resolve => {
+    els.priceDialog.onclose = ()=> resolve(els.priceDialog.returnValue === "ok" ? els.priceInput.value.trim() : "");
+    els.priceDialog.returnValue = "";
+    els.priceDialog.showModal();
+  });
+}
+
+// dopo un'azione si rilegge solo la riga toccata, senza attenderla (di solito l'SSE arriva prima)
+function refreshJob(id){
+  return fetch(`/api/admin/jobs/${encodeURIComponent(id)}`, { headers:{ Authorization:`Bearer ${token}` }, cache:"no-store" })
+    .then(r => r.ok ? r.json() : null)
+    .then(d => { if(d && d.job) applyDelta({ jobs:[d.job] }); })
+    .catch(()=>{});
+}
+
+async function resend(id){
+  const r = await fetch(`/api/admin/resend-email/${encodeURIComponent(id)}`, {
+    method:"POST", headers:{ Authorization:`Bearer ${token}` }
+  });
+  showToast(r.ok ? "Email inviata" : "Errore reinvio", r.ok);
+  if(r.ok) refreshJob(id);
+}
+
+async function publish(id){
+  const prezzo = await askPrice();
+  if(!prezzo) return;
+  const r = await fetch(`/api/admin/publish/${encodeURIComponent(id)}?price=${encodeURIComponent(prezzo)}`, {
+    method:"POST", headers:{ Authorization:`Bearer ${token}` }
+  });
+  const data = await r.json().catch(()=> ({}));
+  if(r.ok){
+    showToast("Pubblicato ✅");
+    refreshJob(id);
+  }else{
+    showToast("Errore pubblicazione: " + (data.detail || r.status), false);
+  }
+}
 
-<h1>Eccomi Video — Dashboard</h1>
-<p><small>Auto-refresh 6s · <a href="#" id="refresh">Aggiorna ora</a></small></p>
+// un solo listener sul tbody per i bottoni di tutte le righe
+const actions = { publish, resend };
+tbody.addEventListener("click", (e)=>{
+  const b = e.target.closest("button[data-action]");
+  if(!b) return;
+  const fn = actions[b.dataset.action];
+  if(fn) fn(b.dataset.id);
+});
+
+function setMsg(text, ok=true){
+  els.msg.textContent = text;
+  els.msg.style.color = ok ? "green" : "crimson";
+}
+els.create.onclick = async ()=>{
+  setMsg("Invio in corso...", true);
+  const t = selType.value;
+  const order_name = els.order_name.value || "ManualOrder";
+  const to_email = els.to_email.value || "";
 
-<section id="creator">
+  let url, body;
+  if(t === 'did-photo'){
+    const image_url = els.image_url.value.trim();
+    const voice = els.voice.value.trim() || "ms:it-IT-GiuseppeNeural";
+    const script = els.script.value.trim();
+    const audio_url = els.audio_url.value.trim();
+    if(!image_url){ setMsg("Image URL obbligatorio", false); return; }
+    if(!script && !audio_url){ setMsg("Scrivi uno script o passa un audio_url", false); return; }
+    url = "/api/jobs/photo";
+    body = { image_url, voice, script: script||undefined, audio_url: audio_url||undefined,
+             to_email: to_email||undefined, order_name };
+  } else if(t === 'hg-text'){
+    const script = els.hg_script.value.trim();
+    if(!script){ setMsg("Script obbligatorio", false); return; }
+    url = "/api/heygen/submit";
+    body = { script,
+             avatar_id: (els.hg_avatar.value||undefined),
+             voice_id: (els.hg_voice.value||undefined),
+             to_email: to_email||undefined, order_name };
+  } else { // hg-audio
+    const audio_url = els.hg_audio_url.value.trim();
+    if(!audio_url){ setMsg("Audio URL obbligatorio", false); return; }
+    url = "/api/heygen/submit-audio";
+    body = { audio_url,
+             avatar_id: (els.hg_avatar2.value||undefined),
+             to_email: to_email||undefined, order_name };
+  }
+
+  const r = await fetch(url, {
+    method:"POST",
+    headers:{ "Content-Type":"application/json" },
+    body: JSON.stringify(body)
+  });
+  const data = await r.json().catch(()=> ({}));
+  if(!r.ok){
+    setMsg("Errore: " + (data.detail || r.status), false);
+    return;
+  }
+  setMsg("Creato! Aggiorno tabella…", true);
+  safeLoad();
+};
+"""
+
+DASHBOARD_TEMPLATE = """
+<!doctype html><html lang="it"><meta charset="utf-8"/>
+<meta name="viewport" content="width=device-width,initial-scale=1"/>
+<title>{{ title }}</title>
+<link rel="stylesheet" href="{{ css_url }}"/>
+<!-- in testa con defer: lo script si scarica insieme al CSS mentre l'HTML viene ancora letto -->
+<script src="{{ js_url }}" defer></script>
+
+<h1>{{ title }}</h1>
+<p><small><span id="live">Aggiornamenti in tempo reale</span> · <a href="#" id="refresh">Aggiorna ora</a></small></p>
+
+<section id="creator" data-mode="did-photo">
   <h3>Crea nuovo lavoro</h3>
   <div class="grid3">
     <div>
@@ -517,7 +1620,7 @@ hr{border:none;border-top:1px solid #eee;margin:12px 0}
     </div>
   </div>
 
-  <div id="did-fields">
+  <div id="did-fields" class="only-did">
     <div class="grid">
       <div>
         <label>Image URL (obbligatorio)</label>
@@ -534,7 +1637,7 @@ hr{border:none;border-top:1px solid #eee;margin:12px 0}
     <input id="audio_url" placeholder="https://...mp3">
   </div>
 
-  <div id="hg-text-fields" style="display:none">
+  <div id="hg-text-fields" class="only-hg-text">
     <label>Script (obbligatorio)</label>
     <textarea id="hg_script" rows="3" placeholder="Testo per l'avatar Heygen"></textarea>
     <div class="grid">
@@ -549,7 +1652,7 @@ hr{border:none;border-top:1px solid #eee;margin:12px 0}
     </div>
   </div>
 
-  <div id="hg-audio-fields" style="display:none">
+  <div id="hg-audio-fields" class="only-hg-audio">
     <div class="grid">
       <div>
         <label>Audio URL (obbligatorio)</label>
@@ -567,137 +1670,64 @@ hr{border:none;border-top:1px solid #eee;margin:12px 0}
   <span id="msg" style="margin-left:8px"></span>
 </section>
 
-<table id="jobs"><thead>
+<div id="jobs-wrap"><table id="jobs"><thead>
 <tr><th>ID</th><th>Provider</th><th>Status</th><th>Video</th><th>Email</th><th>Ordine</th><th>Azioni</th></tr>
-</thead><tbody></tbody></table>
-
-<script>
-function askToken(){
-  let tk = new URLSearchParams(location.search).get("token");
-  if(!tk) tk = sessionStorage.getItem("eccomi_admin_token") || "";
-  if(!tk){ tk = prompt("Inserisci ADMIN_TOKEN"); }
-  if(!tk){ document.body.innerHTML = "<p>Token mancante.</p>"; return null; }
-  sessionStorage.setItem("eccomi_admin_token", tk);
-  return tk;
-}
-const token = askToken(); if(!token) throw new Error("No token");
+</thead><tbody></tbody></table></div>
 
-// toggle campi
-const selType = document.getElementById('type');
-const didBox = document.getElementById('did-fields');
-const hgTextBox = document.getElementById('hg-text-fields');
-const hgAudioBox = document.getElementById('hg-audio-fields');
-function updateFields(){
-  const t = selType.value;
-  didBox.style.display = (t==='did-photo')?'block':'none';
-  hgTextBox.style.display = (t==='hg-text')?'block':'none';
-  hgAudioBox.style.display = (t==='hg-audio')?'block':'none';
-}
-selType.onchange = updateFields; updateFields();
+<dialog id="priceDialog"><form method="dialog">
+  <label>Prezzo prodotto (€)</label>
+  <input id="priceInput" value="19" inputmode="decimal">
+  <p><button class="btn" value="ok" id="priceOk">Pubblica</button> <button class="btn" value="">Annulla</button></p>
+</form></dialog>
+<div id="toast"></div>
 
-async function load(){
-  const r = await fetch('/api/admin/jobs', { headers:{ Authorization:`Bearer ${token}` }});
-  if(!r.ok){ document.body.innerHTML = "<p>Unauthorized</p>"; return; }
-  const data = await r.json();
-  const tbody = document.querySelector("#jobs tbody");
-  tbody.innerHTML = "";
-  for(const j of (data.jobs||[])){
-    const tr = document.createElement("tr");
-    const v = j.video_url ? `<a href="${j.video_url}" target="_blank">apri</a>` : "";
-    const pub = j.video_url ? `<button class="btn" onclick="publish('${j.id}')">Pubblica</button>` : `<button class="btn" disabled>Pubblica</button>`;
-    const resend = j.video_url ? `<button class="btn" onclick="resend('${j.id}')">Re-invia email</button>` : `<button class="btn" disabled>Re-invia email</button>`;
-    tr.innerHTML = `
-      <td><code>${j.id||""}</code><br><small>${j.updated_at||""}</small></td>
-      <td>${j.provider||""}</td>
-      <td><span class="badge">${j.status||""}</span></td>
-      <td>${v}</td>
-      <td>${j.to_email||""}</td>
-      <td>${j.order_name||""}</td>
-      <td>${pub} ${resend} ${j.shopify_url?('<a class="btn" target="_blank" href="'+j.shopify_url+'">Prodotto</a>'):''}</td>
-    `;
-    tbody.appendChild(tr);
-  }
-}
-document.getElementById("refresh").onclick = (e)=>{ e.preventDefault(); load(); };
-setInterval(load, 6000); load();
+</html>
+"""
 
-async function resend(id){
-  const r = await fetch(`/api/admin/resend-email/${encodeURIComponent(id)}`, {
-    method:"POST", headers:{ Authorization:`Bearer ${token}` }
-  });
-  alert(r.ok ? "Email inviata" : "Errore reinvio");
-}
+# CSS e JS come asset separati con l'hash nel nome: immutabili, il browser li tiene in cache
+# e a ogni visita rivalida solo l'HTML
+_DASHBOARD_ASSETS: Dict[str, Tuple[bytes, bytes, str]] = {}  # nome -> (corpo, corpo gzip, media type)
+
+def _dashboard_asset(src: str, ext: str, media_type: str) -> str:
+    raw = src.encode("utf-8")
+    name = f"dashboard.{hashlib.blake2b(raw, digest_size=8).hexdigest()}.{ext}"
+    _DASHBOARD_ASSETS[name] = (raw, gzip.compress(raw, compresslevel=6), media_type)
+    return f"/dashboard/static/{name}"
+
+# template compilato e reso una volta sola all'import: a richiesta si servono solo byte già pronti
+_JINJA = Environment(autoescape=select_autoescape(default=True), auto_reload=False)
+DASHBOARD_HTML = _JINJA.from_string(DASHBOARD_TEMPLATE).render(
+    title="Eccomi Video — Dashboard",
+    css_url=_dashboard_asset(DASHBOARD_CSS, "css", "text/css; charset=utf-8"),
+    js_url=_dashboard_asset(DASHBOARD_JS, "js", "application/javascript; charset=utf-8"),
+)
 
-async function publish(id){
-  const prezzo = prompt("Prezzo prodotto (€)", "19");
-  if(!prezzo) return;
-  const r = await fetch(`/api/admin/publish/${encodeURIComponent(id)}?price=${encodeURIComponent(prezzo)}`, {
-    method:"POST", headers:{ Authorization:`Bearer ${token}` }
-  });
-  const data = await r.json().catch(()=> ({}));
-  if(r.ok){
-    alert("Pubblicato ✅");
-    load();
-  }else{
-    alert("Errore pubblicazione: " + (data.detail || r.status));
-  }
+# corpo già codificato (e compresso) una volta sola all'import
+_DASHBOARD_BYTES = DASHBOARD_HTML.encode("utf-8")
+_DASHBOARD_GZ = gzip.compress(_DASHBOARD_BYTES, compresslevel=6)
+# la pagina è statica (i dati arrivano da /api/admin/jobs): il browser può tenerla qualche minuto
+# e poi rivalidarla con l'ETag (uno per codifica, le due varianti non sono gli stessi byte)
+_DASHBOARD_TAG = hashlib.blake2b(_DASHBOARD_BYTES, digest_size=8).hexdigest()
+_DASHBOARD_HEADERS = {"Vary": "Accept-Encoding", "Cache-Control": "private, max-age=300"}
+_DASHBOARD_VARIANTS = {
+    True: (_DASHBOARD_GZ, {**_DASHBOARD_HEADERS, "Content-Encoding": "gzip", "ETag": f'"{_DASHBOARD_TAG}-gz"'}),
+    False: (_DASHBOARD_BYTES, {**_DASHBOARD_HEADERS, "ETag": f'"{_DASHBOARD_TAG}"'}),
 }
 
-window.resend = resend;
-window.publish = publish;
-
-function setMsg(text, ok=true){
-  const el = document.getElementById('msg');
-  el.textContent = text;
-  el.style.color = ok ? "green" : "crimson";
-}
-document.getElementById('create').onclick = async ()=>{
-  setMsg("Invio in corso...", true);
-  const t = selType.value;
-  const order_name = document.getElementById('order_name').value || "ManualOrder";
-  const to_email = document.getElementById('to_email').value || "";
-
-  let url, body;
-  if(t === 'did-photo'){
-    const image_url = document.getElementById('image_url').value.trim();
-    const voice = document.getElementById('voice').value.trim() || "ms:it-IT-GiuseppeNeural";
-    const script = document.getElementById('script').value.trim();
-    const audio_url = document.getElementById('audio_url').value.trim();
-    if(!image_url){ setMsg("Image URL obbligatorio", false); return; }
-    if(!script && !audio_url){ setMsg("Scrivi uno script o passa un audio_url", false); return; }
-    url = "/api/jobs/photo";
-    body = { image_url, voice, script: script||undefined, audio_url: audio_url||undefined,
-             to_email: to_email||undefined, order_name };
-  } else if(t === 'hg-text'){
-    const script = document.getElementById('hg_script').value.trim();
-    if(!script){ setMsg("Script obbligatorio", false); return; }
-    url = "/api/heygen/submit";
-    body = { script,
-             avatar_id: (document.getElementById('hg_avatar').value||undefined),
-             voice_id: (document.getElementById('hg_voice').value||undefined),
-             to_email: to_email||undefined, order_name };
-  } else { // hg-audio
-    const audio_url = document.getElementById('hg_audio_url').value.trim();
-    if(!audio_url){ setMsg("Audio URL obbligatorio", false); return; }
-    url = "/api/heygen/submit-audio";
-    body = { audio_url,
-             avatar_id: (document.getElementById('hg_avatar2').value||undefined),
-             to_email: to_email||undefined, order_name };
-  }
-
-  const r = await fetch(url, {
-    method:"POST",
-    headers:{ "Content-Type":"application/json" },
-    body: JSON.stringify(body)
-  });
-  const data = await r.json().catch(()=> ({}));
-  if(!r.ok){
-    setMsg("Errore: " + (data.detail || r.status), false);
-    return;
-  }
-  setMsg("Creato! Aggiorno tabella…", true);
-  load();
-};
-</script>
-</html>
-"""
+@app.get("/dashboard", response_class=HTMLResponse)
+def dashboard_page(request: Request):
+    body, headers = _DASHBOARD_VARIANTS["gzip" in request.headers.get("accept-encoding", "")]
+    if request.headers.get("if-none-match") == headers["ETag"]:
+        return Response(status_code=304, headers={k: v for k, v in headers.items() if k != "Content-Encoding"})
+    return Response(body, media_type="text/html; charset=utf-8", headers=headers)
+
+_ASSET_HEADERS = {"Vary": "Accept-Encoding", "Cache-Control": "public, max-age=31536000, immutable"}
+
+@app.get("/dashboard/static/{name}", include_in_schema=False)
+def dashboard_asset(name: str, request: Request):
+    asset = _DASHBOARD_ASSETS.get(name)
+    if not asset: raise HTTPException(404, "Not found")
+    raw, gz, media_type = asset
+    if "gzip" in request.headers.get("accept-encoding", ""):
+        return Response(gz, media_type=media_type, headers={**_ASSET_HEADERS, "Content-Encoding": "gzip"})
+    return Response(raw, media_type=media_type, headers=_ASSET_HEADERS)